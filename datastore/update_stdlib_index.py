@@ -0,0 +1,43 @@
+"""
+Build the standard library index used by the bot to look up library reference links
+without having to guess the url and check it against the docs site.
+
+Requires sphobjinv (pip install sphobjinv), it is only needed to run this script and not the bot.
+
+Run from the repo root: python datastore/update_stdlib_index.py
+To build from an objects.inv that was already downloaded: python datastore/update_stdlib_index.py path/to/objects.inv
+"""
+
+from json import dumps
+from pathlib import Path
+import sys
+import sphobjinv as soi
+
+docs_url = "https://docs.python.org/3/"
+index_path = Path.cwd() / "datastore" / "stdlib_index.json"
+
+# Sphinx object types that get linked to as library references.
+# Data and attributes are included so things like `sys.path` are found.
+roles = {"module", "function", "class", "method", "exception", "data", "attribute"}
+
+# objects.inv is the index sphinx uses for cross referencing between docs sites.
+# It lists every documented object along with the page and anchor it is found at.
+# The links have to point at the same version of the docs the objects.inv came from, otherwise
+# they could link to pages that have been removed. A downloaded file could be from any version
+# so its links use the version recorded in the file (ex. https://docs.python.org/3.9/).
+if len(sys.argv) > 1:
+    inventory = soi.Inventory(fname_zlib=sys.argv[1])
+    docs_base = f"https://docs.python.org/{inventory.version}/"
+else:
+    inventory = soi.Inventory(url=docs_url + "objects.inv")
+    docs_base = docs_url
+
+stdlib_index = {}
+
+for inventory_object in inventory.objects:
+
+    if inventory_object.domain == "py" and inventory_object.role in roles:
+        stdlib_index[inventory_object.name] = docs_base + inventory_object.uri_expanded
+
+with open(index_path, "w") as index_file:
+    index_file.write(dumps(stdlib_index, indent=4, sort_keys=True))
@@ -11,14 +11,20 @@ Bot's reddit: https://www.reddit.com/user/py_reference_bot
 """
 
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import configparser
+from functools import lru_cache
 from json import loads
 import logging
 from os import environ
 from pathlib import Path
-from re import search, MULTILINE
-from requests import get
-from fuzzywuzzy import fuzz
+from queue import Queue
+from re import compile as re_compile, MULTILINE
+from threading import Thread
+from time import monotonic, sleep
+import httpx
+import numpy as np
+from rapidfuzz import fuzz, process, utils
 import praw
 
 
@@ -33,21 +39,121 @@ LOGGER = logging.getLogger("py_docs_bot")
 # everytime it needs the data in the functions that require it
 try:
     datastore_path = Path.cwd() / "datastore" / "datastore.json"
-    with open(datastore_path, "r") as datastore_file:
-        DATASTORE = loads(datastore_file.read())
+    DATASTORE = loads(datastore_path.read_bytes())
     LOGGER.debug("Set global variable 'DATASTORE' from file: datastore.json.")
 except Exception as e:
     LOGGER.error("Could not open file 'datastore.json'. %s", e)
     raise SystemExit
 
+# Map of every documented standard library module, class, function, etc. to its link in the docs.
+# Built by datastore/update_stdlib_index.py. When it is loaded it is the only place library links come from.
+# The bot still works without it, it just falls back to guessing the link and checking it against the docs site.
+try:
+    stdlib_index_path = Path.cwd() / "datastore" / "stdlib_index.json"
+    STDLIB_INDEX = loads(stdlib_index_path.read_bytes())
+    LOGGER.debug("Set global variable 'STDLIB_INDEX' from file: stdlib_index.json.")
+except Exception as e:  # pylint:disable=broad-except
+    LOGGER.warning("Could not open file 'stdlib_index.json'. Library links will be checked online. %s", e)
+    STDLIB_INDEX = {}
+
+# Matches the bot keyword at the start of a line and captures the comma seperated references after it.
+# Only spaces or tabs can come after the keyword so the references have to be on the same line.
+# Compiled once here since it runs against every comment in the subreddit.
+DOCS_RE = re_compile(r"^\!docs[ \t]+(.+)$", MULTILINE)
+
+# The datastore never changes while the bot is running so normalize it once here instead of on every command.
+# PROCESSED_TITLES are the titles with the same processing (lowercase, punctuation stripped) that the
+# fuzzy matching would otherwise do on every comparison.
+# DOCS_LINKS has the (title cased title used in the reply, link) for the title at the same index.
+# Kept as lists (not a dict) because a few titles are repeated across pages.
+PROCESSED_TITLES = [utils.default_process(reference_entry["title"]) for reference_entry in DATASTORE["docs_sections"]]
+DOCS_LINKS = [
+    (reference_entry["title"].title(), reference_entry["link"]) for reference_entry in DATASTORE["docs_sections"]
+]
+BUILTIN_FUNCTIONS_SET = frozenset(DATASTORE["builtin_functions"])
+
+# One client for all of the link checks so the connection to the docs site gets reused
+# instead of doing a new TCP and TLS handshake for every link. With HTTP/2 the link checks
+# running at the same time on the thread pool all share a single connection.
+CLIENT = httpx.Client(
+    http2=True,
+    timeout=3,
+    limits=httpx.Limits(max_connections=16, max_keepalive_connections=4),
+)
+
+# Thread pool for the link checks. They are independent network calls so there is no reason to
+# wait on them one at a time.
+EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
+# How long (in seconds) to trust cached link checks before checking the docs site again
+URL_CACHE_TTL = 6 * 60 * 60
+
+# Index of every pep that has been published. Used to throw out pep numbers that don't exist
+# without having to make a request for them.
+PEP_INDEX_URL = "https://peps.python.org/api/peps.json"
+# How long (in seconds) before downloading the pep index again to pick up new peps
+PEP_INDEX_TTL = 7 * 24 * 60 * 60
+
+
+@lru_cache(maxsize=4096)
+def _cached_url_exists(url):
+    """
+    Check if a documentation link is valid. The same references get requested over and over
+    so cache the result instead of hitting the docs site every time.
+    Only a HEAD request is sent since we just need the status code and not the page itself.
+    """
+
+    return CLIENT.head(url, follow_redirects=True).status_code == 200
+
+
+def _url_exists(url):
+    """
+    Check if a documentation link is valid without letting a network error or a bad url take down the bot.
+    Errors are caught out here, outside of the cache, so a timeout isn't remembered as a bad link.
+    InvalidURL (ex. a tab in the url) isn't a subclass of HTTPError so it has to be caught on its own.
+    """
+
+    try:
+        return _cached_url_exists(url)
+    except (httpx.HTTPError, httpx.InvalidURL) as e:
+        LOGGER.error("Could not check link: %s. %s", url, e)
+        return False
+
+
+def _load_valid_peps():
+    """
+    Download the pep index and return the set of valid pep numbers.
+    Returns None if the index could not be downloaded so callers can fall back to checking the link.
+    """
+
+    try:
+        response = CLIENT.get(PEP_INDEX_URL, follow_redirects=True, timeout=10)
+        response.raise_for_status()
+        valid_peps = frozenset(int(pep_number) for pep_number in response.json())
+        LOGGER.debug("Loaded %d peps from: %s", len(valid_peps), PEP_INDEX_URL)
+        return valid_peps
+    except (httpx.HTTPError, ValueError) as e:
+        LOGGER.error("Could not load the pep index. %s", e)
+        return None
+
 
 class PyDocsBot:
     """
     Do all the bot things
     """
 
-    def __init__(self, subreddit):
+    def __init__(self, subreddit, reply_reddit):
         self.subreddit = subreddit
+        self.url_cache_cleared = monotonic()
+        self.valid_peps = _load_valid_peps()
+        self.valid_peps_loaded = monotonic()
+        # PRAW is not thread safe so the reply worker gets its own reddit instance (reply_reddit)
+        # instead of sharing the one the comment stream is using. Only comment ids are passed to it.
+        # Replies are (comment_id, comment_markdown) pairs and None tells the worker to stop.
+        self.reply_reddit = reply_reddit
+        self.reply_queue = Queue()
+        self.reply_thread = Thread(target=self._reply_worker, name="reply_worker", daemon=True)
+        self.reply_thread.start()
 
     def monitor_and_reply_to_comments(self):
         """
@@ -57,6 +163,18 @@ class PyDocsBot:
 
         LOGGER.info("Monitoring r/learnpython comments for keyword '!docs'")
 
+        try:
+            self._scan_comments()
+        finally:
+            # Let the reply worker finish posting what is already queued and then stop so a restart
+            # doesn't leave an old worker thread behind.
+            self.reply_queue.put(None)
+
+    def _scan_comments(self):
+        """
+        Scan new comments for the bot keyword and queue up a reply with the links for each command found.
+        """
+
         # Loop over comment objects returned from reddit. skip_existing=True means that when the bot
         # starts it will not go back and get existing comments and instead start with new ones.
         for comment in self.subreddit.stream.comments(skip_existing=True):
@@ -64,40 +182,120 @@ class PyDocsBot:
             # Check for keyword !docs in comment. If found get reference links from python documentatiom
             # Module paths are case sensitive.
             # Command usage: !docs pathlib.Path, re.search, zip, while, pep-8
-            if bool(search(r"^\!docs.+$", comment.body, flags=MULTILINE)):
-                LOGGER.info("New command received: %s", repr(comment.body))
-                needed_references = (
-                    search(r"^\!docs\s(.+)$", comment.body, flags=MULTILINE)
-                    .group(1)
-                    .replace(" ", "")
-                    .split(",")
+            # Almost none of the comments will have the keyword so do a quick substring check
+            # before running the regex.
+            body = comment.body
+            if "!docs" not in body:
+                continue
+
+            command = DOCS_RE.search(body)
+            if not command:
+                continue
+
+            LOGGER.info("New command received: %s", repr(body))
+            self._expire_url_cache()
+            self._refresh_valid_peps()
+            # Remove all whitespace from each reference (spaces, tabs, a trailing \r, etc.) so none of it
+            # ends up in a link.
+            # Drop duplicate and blank references (ex. `!docs zip, zip,`) so they are only looked up once.
+            # dict.fromkeys keeps the references in the order they were requested.
+            needed_references = list(
+                dict.fromkeys(
+                    reference
+                    for reference in ("".join(reference.split()) for reference in command.group(1).split(","))
+                    if reference
                 )
+            )
+
+            # Queries that returned no results don't add anything to the list
+            comment_parts = self._get_reference_links(needed_references)
+
+            if comment_parts:
+                comment_parts.append(
+                    "  \nPython Documentation Bot - *[How To Use](https://github.com/trevormiller6/Py-Docs-Bot)*"
+                )
+                comment_markdown = "".join(comment_parts)
+                self.reply_queue.put((comment.id, comment_markdown))
+            else:
+                LOGGER.error(
+                    "The request was not valid no response sent. Requested docs: %s",
+                    needed_references,
+                )
+
+    def _reply_worker(self):
+        """
+        Post the replies waiting in the reply queue to reddit. Runs in its own thread so the comment stream
+        can keep being scanned while a reply is being sent.
+        """
+
+        while True:
+            reply = self.reply_queue.get()
+            if reply is None:
+                break
 
-                # Filter out empty strings for queries that returned no results
-                all_links = [
-                    link
-                    for link in [
-                        self._library_reference_docs(reference)
-                        + self._language_reference_docs(reference)
-                        + self._python_enhancement_proposals(reference)
-                        for reference in needed_references
-                    ]
-                    if link
-                ]
-
-                if all_links:
-                    comment_markdown = f"{''.join(all_links)}  \nPython Documentation Bot - *[How To Use](https://github.com/trevormiller6/Py-Docs-Bot)*"
-                    comment.reply(comment_markdown)
-                    LOGGER.info("Replied to a comment: %s", repr(comment_markdown))
-                else:
-                    LOGGER.error(
-                        "The request was not valid no response sent. Requested docs: %s",
-                        needed_references,
-                    )
+            comment_id, comment_markdown = reply
+            try:
+                self.reply_reddit.comment(id=comment_id).reply(comment_markdown)
+                LOGGER.info("Replied to a comment: %s", repr(comment_markdown))
+            except Exception as e:  # pylint:disable=broad-except
+                LOGGER.error("Could not reply to a comment. %s", e)
+
+    def _get_reference_links(self, needed_references):
+        """
+        Get the markdown links for all of the references as one flat list, in the same order they were requested.
+        The library and pep lookups have to check the docs site so they are run on the thread pool
+        all at once. The language reference lookup is just fuzzy matching so it runs here while
+        those are waiting on the network.
+        """
+
+        # Maps each future back to the reference it belongs to and which lookup it was
+        futures = {}
+        for index, reference in enumerate(needed_references):
+            futures[EXECUTOR.submit(self._library_reference_docs, reference)] = (index, 0)
+            futures[EXECUTOR.submit(self._python_enhancement_proposals, reference)] = (index, 2)
+
+        # One row per reference: library link, language reference links, pep link
+        results = [
+            [[], language_links, []]
+            for language_links in self._language_reference_docs(needed_references)
+        ]
+
+        for future in as_completed(futures):
+            index, position = futures[future]
+            results[index][position] = future.result()
+
+        # Collect every link into one list so the reply only has to be joined once
+        comment_parts = []
+        for result in results:
+            for links in result:
+                comment_parts.extend(links)
+
+        return comment_parts
+
+    def _expire_url_cache(self):
+        """
+        Clear the cached link checks every URL_CACHE_TTL seconds so pages that get added or removed
+        from the docs site are picked up without restarting the bot.
+        """
+
+        if monotonic() - self.url_cache_cleared > URL_CACHE_TTL:
+            LOGGER.debug("Clearing cached link checks: %s", _cached_url_exists.cache_info())
+            _cached_url_exists.cache_clear()
+            self.url_cache_cleared = monotonic()
+
+    def _refresh_valid_peps(self):
+        """
+        Download the pep index again every PEP_INDEX_TTL seconds so new peps can be requested.
+        If the download fails keep using the index we already have.
+        """
+
+        if monotonic() - self.valid_peps_loaded > PEP_INDEX_TTL:
+            self.valid_peps = _load_valid_peps() or self.valid_peps
+            self.valid_peps_loaded = monotonic()
 
     def _python_enhancement_proposals(self, reference):
         """
-        Get links to python peps
+        Get links to python peps. Returns a list with the markdown link, or an empty list if there isn't one.
         """
 
         reference = reference.lower()
@@ -106,62 +304,98 @@ class PyDocsBot:
         # Just for fun
         if reference in ["zen", "zenofpython", "pep-20"]:
 
-            return "[The Zen of Python](https://www.python.org/dev/peps/pep-0020)  \n\n    >>> import this  \n  \n"
+            return ["[The Zen of Python](https://www.python.org/dev/peps/pep-0020)  \n\n    >>> import this  \n  \n"]
 
         # Extract the pep number
         try:
             _, pep_number = reference.split("-")
         except Exception:  # pylint:disable=broad-except
 
-            return ""
+            return []
 
         #  Make sure it is actually a number
         try:
             pep_number = int(pep_number)
         except ValueError:
 
-            return ""
+            return []
+
+        # Skip the request if the pep index says there is no pep with this number.
+        # If the index could not be loaded then just check the link like normal.
+        if self.valid_peps is not None and pep_number not in self.valid_peps:
+
+            return []
 
         # Pep links have 4 numbers in the url so pad with leading zeros if needed
         pep_number = f"{pep_number:04d}"
 
         link = f"https://www.python.org/dev/peps/pep-{pep_number}"
 
-        return f"[{reference.upper()}]({link})  \n  \n" if bool(get(link)) else ""
+        # Peps found in the index don't need their link checked
+        if self.valid_peps is not None or _url_exists(link):
+
+            return [f"[{reference.upper()}]({link})  \n  \n"]
 
-    def _language_reference_docs(self, reference):
+        return []
+
+    def _language_reference_docs(self, references):
         """
-        Get links to reference documentation from the python docs site.
+        Get links to reference documentation from the python docs site for each of the references.
+        Returns a list of markdown links for each reference, in the same order as the references.
         I use fuzzy searching here so that docs called up without having to know the actual title of the reference
         that is being requested. Requires a minimum match score of 85. May need to tweak this number... not sure yet.
         """
 
-        matched_references = []
-
-        for reference_entry in DATASTORE["docs_sections"]:
-
-            match_ratio = fuzz.token_set_ratio(
-                reference_entry["title"], reference.lower()
-            )
-
-            if match_ratio > 85:
-                matched_references.append(
-                    f'[{reference_entry["title"].title()}]({reference_entry["link"]})  \n  \n'
-                )
-
-        return "".join(matched_references) if matched_references else ""
+        # Score every reference against every title in one call instead of looping in python.
+        # Scores under the cutoff come back as 0. fuzzywuzzy rounded the score before checking it against 85
+        # so a cutoff of 85.5 on the unrounded score keeps the same matches.
+        # workers=-1 spreads the scoring across all cpu cores.
+        # The titles are already processed so each reference is processed once here and processor=None
+        # skips processing every pair again when scoring.
+        scores = process.cdist(
+            [utils.default_process(reference) for reference in references],
+            PROCESSED_TITLES,
+            scorer=fuzz.token_set_ratio,
+            processor=None,
+            score_cutoff=85.5,
+            workers=-1,
+            dtype=np.uint8,
+        )
+
+        # One row of scores per reference. nonzero returns the matched titles in the order they appear in the docs
+        return [
+            [
+                f"[{DOCS_LINKS[index][0]}]({DOCS_LINKS[index][1]})  \n  \n"
+                for index in np.nonzero(row)[0]
+            ]
+            for row in scores
+        ]
 
     def _library_reference_docs(self, reference):
         """
         Get links to the documentation on the standard library.
         Python kinda standardized their link structure for their documentation
         but there is a little weirdness that we check for.
+        Returns a list with the markdown link, or an empty list if there isn't one.
         """
 
+        # Anything in the standard library index already has its exact link so no need to guess it
+        if reference in STDLIB_INDEX:
+
+            return [f"[{reference}]({STDLIB_INDEX[reference]})  \n  \n"]
+
+        # The index has everything in the library docs so if it loaded and the reference isn't in it
+        # there is nothing to find. Keywords and peps (ex. while, pep-8) end up here every time so this
+        # saves checking links that will never exist.
+        if STDLIB_INDEX:
+
+            return []
+
+        # The index could not be loaded so fall back to guessing the link and checking it.
         # For python built-in functions (zip, map, filter, enumerate, etc.), they did not get their own
         # page and instead are all on one page.
         # So the only thing we needed to set was the page anchor
-        if reference in DATASTORE["builtin_functions"]:
+        if reference in BUILTIN_FUNCTIONS_SET:
             link = f"https://docs.python.org/3/library/functions.html#{reference}"
         # If the reference was not a built-in function attempt to create a link with the full module name,
         # ex. `pathlib.Path`.
@@ -170,22 +404,26 @@ class PyDocsBot:
         else:
             link = f"https://docs.python.org/3/library/{reference}.html#{reference}"
 
-        if bool(get(link)):
+        if _url_exists(link):
 
-            return f"[{reference}]({link})  \n  \n"
+            return [f"[{reference}]({link})  \n  \n"]
 
         # If after testing the above links to python documentation fails than there is one last url path to try.
         # This is actually the url path that most of the documentation will have.
-        # Split on the `.` and grab the first item in the list which will be the library name ex. pathlib.Path
-        # becomes just pathlib which will be the name of the html file we want to go to. Then we use the full
-        # method path `pathlib.Path` for the page anchor
-        else:
-            link = f"https://docs.python.org/3/library/{reference.split('.')[0]}.html#{reference}"
+        # Partition on the first `.` to get the library name ex. pathlib.Path becomes just pathlib which will be
+        # the name of the html file we want to go to. Then we use the full method path `pathlib.Path` for the
+        # page anchor. If there is no `.` this would be the same link we just checked so skip it.
+        library, separator, _ = reference.partition(".")
+        if separator:
+            link = f"https://docs.python.org/3/library/{library}.html#{reference}"
 
-            return f"[{reference}]({link})  \n  \n" if bool(get(link)) else ""
+            if _url_exists(link):
 
-            # If all of the above failed then it most likely is not a python standard library or function
-            # or the user had a typo.
+                return [f"[{reference}]({link})  \n  \n"]
+
+        # If all of the above failed then it most likely is not a python standard library or function
+        # or the user had a typo.
+        return []
 
 
 def main():
@@ -220,31 +458,50 @@ def main():
 
     bot_user_agent = "(praw-python3.9) py_docs_bot - scanning comments in r/learnpython and replying with python documentation links"
     LOGGER.debug("Authenticating to reddit")
-    # Instantiate reddit class and authenticate
-    reddit = praw.Reddit(
-        client_id=reddit_api_id,
-        client_secret=reddit_api_secret,
-        username=reddit_username,
-        password=reddit_password,
-        user_agent=bot_user_agent,
-    )
+    # Instantiate reddit class and authenticate.
+    # PRAW is not thread safe so the thread that posts replies gets its own instance.
+    reddit_settings = {
+        "client_id": reddit_api_id,
+        "client_secret": reddit_api_secret,
+        "username": reddit_username,
+        "password": reddit_password,
+        "user_agent": bot_user_agent,
+    }
+    reddit = praw.Reddit(**reddit_settings)
+    reply_reddit = praw.Reddit(**reddit_settings)
     LOGGER.debug("Authentication successfull to redit.com")
     # Define subreddit to monitor
     subreddit = reddit.subreddit("learnpython")
     # Initialize the bot.
     LOGGER.info("Python Documentation Bot is Starting Up.")
-    bot = PyDocsBot(subreddit)
+    bot = PyDocsBot(subreddit, reply_reddit)
     bot.monitor_and_reply_to_comments()
 
 
 if __name__ == "__main__":
 
+    # Wait before restarting after an error so the bot doesn't hammer reddit if it is down.
+    # The wait doubles after each failure up to the max, which can be set with an environment variable.
+    max_restart_delay = int(environ.get("REDDIT_DOC_BOT_MAX_RESTART_DELAY", 300))
+    restart_delay = 1
+
     while True:
+        started = monotonic()
         try:
             main()
         except (KeyboardInterrupt, SystemExit):
             LOGGER.info("Good Bye!")
             raise SystemExit
         except Exception as e:  # pylint:disable=broad-except
-            LOGGER.error("Something happened... Restarting!\n\nError: %s", e)
-            continue
+            # If the bot was running for a while before this error start the wait over
+            if monotonic() - started > max_restart_delay:
+                restart_delay = 1
+            LOGGER.error("Something happened... Restarting in %d seconds!\n\nError: %s", restart_delay, e)
+
+        # The wait is outside of the try above so it needs its own check for Ctrl+C
+        try:
+            sleep(restart_delay)
+        except KeyboardInterrupt:
+            LOGGER.info("Good Bye!")
+            raise SystemExit
+        restart_delay = min(restart_delay * 2, max_restart_delay)